@@ -1,5 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import copy
+import os
+
 import numpy as np
 import torch
 
@@ -33,22 +36,26 @@ class RascalSphericalExpansion:
         grad_info = manager.get_gradients_info()
 
         # Step 2: move data around to follow the storage convention
+        all_l = np.arange(hypers["max_angular"] + 1, dtype=np.int32)
+        all_species = np.asarray(global_species, dtype=np.int32)
+        # only generate keys for center species actually present in the
+        # frames, any other one would only produce empty blocks
+        present_species_center = np.intersect1d(all_species, info[:, 2]).astype(
+            np.int32
+        )
+        l_grid, center_grid, neighbor_grid = np.meshgrid(
+            all_l, present_species_center, all_species, indexing="ij"
+        )
         keys = Labels(
             names=["spherical_harmonics_l", "species_center", "species_neighbor"],
-            values=np.array(
-                [
-                    [l, species_center, species_neighbor]
-                    for l in range(hypers["max_angular"] + 1)
-                    for species_center in global_species
-                    for species_neighbor in global_species
-                ],
-                dtype=np.int32,
+            values=np.stack(
+                [l_grid.ravel(), center_grid.ravel(), neighbor_grid.ravel()], axis=1
             ),
         )
 
         properties = Labels(
             names=["n"],
-            values=np.array([[n] for n in range(hypers["max_radial"])], dtype=np.int32),
+            values=np.arange(hypers["max_radial"], dtype=np.int32).reshape(-1, 1),
         )
 
         lm_slices = []
@@ -65,25 +72,57 @@ class RascalSphericalExpansion:
             gradients.shape[0], len(global_species), hypers["max_radial"], -1
         )
 
-        global_to_per_structure_atom_id = []
-        for frame in frames:
-            for i in range(len(frame)):
-                global_to_per_structure_atom_id.append(i)
+        global_to_per_structure_atom_id = np.concatenate(
+            [np.arange(len(frame), dtype=np.int32) for frame in frames]
+        )
+
+        # the masks over `info` only depend on the center species, so compute
+        # them once instead of once per (l, center, neighbor) block
+        species_neighbor_index = {s: i for i, s in enumerate(global_species)}
+        rows_by_species_center = {
+            s: np.flatnonzero(info[:, 2] == s) for s in global_species
+        }
+        samples_by_species_center = {
+            s: Labels(
+                names=["structure", "center"],
+                values=np.ascontiguousarray(info[rows, :2].astype(np.int32)),
+            )
+            for s, rows in rows_by_species_center.items()
+        }
+
+        # same samples, with the atom index reset to a per-structure index
+        # (librascal uses a global atom index)
+        per_structure_samples_by_species_center = {}
+        for s, rows in rows_by_species_center.items():
+            values = np.ascontiguousarray(info[rows, :2].astype(np.int32))
+            values[:, 1] = global_to_per_structure_atom_id[values[:, 1]]
+            per_structure_samples_by_species_center[s] = Labels(
+                names=["structure", "center"], values=values
+            )
+
+        # group the gradient rows by (structure, center, species_neighbor) in a
+        # single pass, instead of scanning the full `grad_info` table for every
+        # sample of every block
+        grad_rows_by_sample = {}
+        if hypers["compute_gradients"] and len(grad_info) != 0:
+            order = np.lexsort((grad_info[:, 4], grad_info[:, 1], grad_info[:, 0]))
+            sorted_keys = grad_info[order][:, [0, 1, 4]]
+            unique_keys, first = np.unique(sorted_keys, axis=0, return_index=True)
+            counts = np.diff(np.append(first, len(order)))
+            for key, start, count in zip(unique_keys, first, counts):
+                grad_rows_by_sample[tuple(key)] = order[start : start + count]
 
         blocks = []
         for l, species_center, species_neighbor in keys:
-            species_neighbor_i = global_species.index(species_neighbor)
-            species_center_mask = np.where(info[:, 2] == species_center)[0]
+            species_neighbor_i = species_neighbor_index[species_neighbor]
+            species_center_mask = rows_by_species_center[species_center]
             block_data = data[species_center_mask, species_neighbor_i, :, lm_slices[l]]
             block_data = block_data.swapaxes(1, 2)
 
-            samples = Labels(
-                names=["structure", "center"],
-                values=np.copy(info[species_center_mask, :2]).astype(np.int32),
-            )
+            samples = samples_by_species_center[species_center]
             spherical_component = Labels(
                 names=["spherical_harmonics_m"],
-                values=np.array([[m] for m in range(-l, l + 1)], dtype=np.int32),
+                values=np.arange(-l, l + 1, dtype=np.int32).reshape(-1, 1),
             )
 
             block_gradients = None
@@ -96,43 +135,46 @@ class RascalSphericalExpansion:
                 # the code below is missing some of the gradient sample, making
                 # the forces not match the energy in a finite difference test
 
-                gradient_samples = []
-                block_gradients = []
+                grad_idx = []
+                grad_sample_idx = []
                 for sample_i, (structure, center) in enumerate(samples):
-                    gradient_mask = np.logical_and(
-                        np.logical_and(
-                            grad_info[:, 0] == structure,
-                            grad_info[:, 1] == center,
-                        ),
-                        grad_info[:, 4] == species_neighbor,
+                    grad_rows = grad_rows_by_sample.get(
+                        (structure, center, species_neighbor), []
+                    )
+                    grad_idx.extend(grad_rows)
+                    grad_sample_idx.extend(len(grad_rows) * [sample_i])
+
+                if len(grad_idx) != 0:
+                    grad_idx = np.asarray(grad_idx)
+                    grad_sample_idx = np.asarray(grad_sample_idx)
+
+                    # gather the 3 spatial rows of all gradients in one call
+                    rows = (3 * grad_idx[:, None] + np.arange(3)).ravel()
+                    gathered = gradients[rows, species_neighbor_i, :, lm_slices[l]]
+                    gathered = gathered.reshape(
+                        len(grad_idx), 3, hypers["max_radial"], 2 * l + 1
                     )
 
-                    for grad_index in np.where(gradient_mask)[0]:
-                        start = 3 * grad_index
-                        stop = 3 * grad_index + 3
-                        block_gradient = gradients[
-                            start:stop, species_neighbor_i, :, lm_slices[l]
-                        ]
-                        block_gradient = block_gradient.swapaxes(1, 2)
-                        block_gradient = block_gradient.reshape(
-                            -1, 3, block_gradient.shape[1], block_gradient.shape[2]
-                        )
-                        if np.linalg.norm(block_gradient) == 0:
-                            continue
-
-                        block_gradients.append(block_gradient)
-
-                        structure = grad_info[grad_index, 0]
-                        neighbor = global_to_per_structure_atom_id[
-                            grad_info[grad_index, 2]
-                        ]
-                        gradient_samples.append((sample_i, structure, neighbor))
-
-                if len(gradient_samples) != 0:
-                    block_gradients = np.concatenate(block_gradients)
+                    non_zero = (
+                        np.linalg.norm(gathered.reshape(len(grad_idx), -1), axis=1)
+                        != 0
+                    )
+                    # the axis swap and the row filter are both lazy on the
+                    # gathered view, so the kept gradients are written to
+                    # their final (samples, 3, m, n) buffer in a single copy
+                    block_gradients = gathered.swapaxes(2, 3)[non_zero]
+                    grad_idx = grad_idx[non_zero]
+                    grad_sample_idx = grad_sample_idx[non_zero]
+
+                    neighbors = global_to_per_structure_atom_id[
+                        grad_info[grad_idx, 2]
+                    ]
                     gradient_samples = Labels(
                         names=["sample", "structure", "atom"],
-                        values=np.vstack(gradient_samples).astype(np.int32),
+                        values=np.stack(
+                            [grad_sample_idx, grad_info[grad_idx, 0], neighbors],
+                            axis=1,
+                        ).astype(np.int32),
                     )
                 else:
                     block_gradients = np.zeros(
@@ -143,20 +185,10 @@ class RascalSphericalExpansion:
                         values=np.zeros((0, 3), dtype=np.int32),
                     )
 
-            # reset atom index (librascal uses a global atom index)
-            samples = Labels(
-                names=["structure", "center"],
-                values=np.array(
-                    [
-                        (structure, global_to_per_structure_atom_id[center])
-                        for structure, center in samples
-                    ],
-                    dtype=np.int32,
-                ),
-            )
+            samples = per_structure_samples_by_species_center[species_center]
 
             block = TensorBlock(
-                values=np.copy(block_data),
+                values=np.ascontiguousarray(block_data),
                 samples=samples,
                 components=[spherical_component],
                 properties=properties,
@@ -226,31 +258,39 @@ class RascalPairExpansion:
             lm_slices.append(slice(start, stop))
             start = stop
 
-        data = []
-        samples = []
-        for i, ijf in enumerate(ijframes):
-            idata = (
-                calculator.transform(ijf)
-                .get_features(calculator)
-                .reshape(len(ijf), max_atoms, hypers["max_radial"], -1)
+        # librascal releases the GIL while computing the expansion, so the
+        # frames can be processed in parallel with a thread pool
+        def expand_single_frame(args):
+            i, ijf = args
+            manager = calculator.transform(ijf)
+            idata = manager.get_features(calculator).reshape(
+                len(ijf), max_atoms, hypers["max_radial"], -1
             )
-            nonzero = np.where((idata**2).sum(axis=(2, 3)) > 1e-20)
-            data.append(
-                idata[nonzero[0], nonzero[1]].reshape(
-                    len(nonzero[0]), hypers["max_radial"], -1
-                )
+            # fused square + sum, avoiding the full `idata**2` temporary
+            norms2 = np.einsum("ijkl,ijkl->ij", idata, idata)
+            nonzero = np.where(norms2 > 1e-20)
+            frame_data = idata[nonzero[0], nonzero[1]].reshape(
+                len(nonzero[0]), hypers["max_radial"], -1
             )
-            samples.append(np.asarray([nonzero[0] * 0 + i, nonzero[0], nonzero[1]]).T)
+            frame_samples = np.asarray([nonzero[0] * 0 + i, nonzero[0], nonzero[1]]).T
+            return frame_data, frame_samples
 
-        data = np.concatenate(data)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(expand_single_frame, enumerate(ijframes)))
+
+        data = np.concatenate([frame_data for frame_data, _ in results])
+        # put the data in (samples, m, n) order once, instead of transposing
+        # and copying it again for every block
+        data = data.transpose(0, 2, 1).copy()
         samples = Labels(
             names=["structure", "center_i", "center_j"],
-            values=np.concatenate(samples).astype(np.int32),
+            values=np.concatenate(
+                [frame_samples for _, frame_samples in results]
+            ).astype(np.int32),
         )
         blocks = []
         for (l,) in keys:
-            block_data = data[..., lm_slices[l]]
-            block_data = block_data.swapaxes(1, 2)
+            block_data = data[:, lm_slices[l], :]
 
             component = Labels(
                 names=["spherical_harmonics_m"],
@@ -258,7 +298,7 @@ class RascalPairExpansion:
             )
 
             block = TensorBlock(
-                values=np.copy(block_data),
+                values=np.ascontiguousarray(block_data),
                 samples=samples,
                 components=[component],
                 properties=properties,
@@ -286,12 +326,14 @@ class SphericalExpansionAutograd(torch.autograd.Function):
 
         grad_descriptor = manager.get_features_gradient(calculator)
         grad_info = manager.get_gradients_info()
+        # torch.from_numpy shares the memory with the numpy arrays instead
+        # of copying them
         ctx.save_for_backward(
-            torch.tensor(grad_descriptor),
-            torch.tensor(grad_info),
+            torch.from_numpy(np.ascontiguousarray(grad_descriptor)),
+            torch.from_numpy(np.ascontiguousarray(grad_info)),
         )
 
-        return samples, torch.tensor(descriptor)
+        return samples, torch.from_numpy(np.ascontiguousarray(descriptor))
 
     @staticmethod
     def backward(ctx, grad_samples, grad_output):
@@ -307,13 +349,16 @@ class SphericalExpansionAutograd(torch.autograd.Function):
                     "missing gradients, please set `compute_gradients` to True"
                 )
 
-            grad_positions = torch.zeros((grad_output.shape[0], 3))
-            for sample, (_, center_i, neighbor_i, *_) in enumerate(grad_info):
-                for spatial_i in range(3):
-                    sample_i = 3 * sample + spatial_i
-                    grad_positions[neighbor_i, spatial_i] += torch.dot(
-                        grad_output[center_i, :], grad_spherical_expansion[sample_i, :]
-                    )
+            grad_positions = torch.zeros(
+                (grad_output.shape[0], 3), dtype=grad_output.dtype
+            )
+            # contract all (sample, direction) pairs in one batched einsum,
+            # then scatter the contributions to the neighbors in one call
+            grad_spx = grad_spherical_expansion.reshape(grad_info.shape[0], 3, -1)
+            contributions = torch.einsum(
+                "nxf, nf -> nx", grad_spx, grad_output[grad_info[:, 1].long()]
+            )
+            grad_positions.index_add_(0, grad_info[:, 2].long(), contributions)
 
         if ctx.needs_input_grad[2]:
             raise ValueError("can not compute gradients w.r.t. cell")
@@ -325,9 +370,11 @@ class SphericalExpansionAutograd(torch.autograd.Function):
 
 class TorchFrame:
     def __init__(self, frame: ase.Atoms, requires_grad: bool):
-        self.positions = torch.tensor(frame.positions, requires_grad=requires_grad)
-        self.species = torch.tensor(frame.numbers)
-        self.cell = torch.tensor(frame.cell[:])
+        self.positions = torch.from_numpy(frame.positions).requires_grad_(
+            requires_grad
+        )
+        self.species = torch.from_numpy(frame.numbers)
+        self.cell = torch.from_numpy(frame.cell[:])
 
     def __len__(self):
         return self.species.shape[0]
@@ -366,22 +413,26 @@ class RascalSphericalExpansionTorch:
         info = np.vstack(all_info)
 
         # Step 2: move data around to follow the storage convention
+        all_l = np.arange(hypers["max_angular"] + 1, dtype=np.int32)
+        all_species = np.asarray(global_species, dtype=np.int32)
+        # only generate keys for center species actually present in the
+        # frames, any other one would only produce empty blocks
+        present_species_center = np.intersect1d(all_species, info[:, 2]).astype(
+            np.int32
+        )
+        l_grid, center_grid, neighbor_grid = np.meshgrid(
+            all_l, present_species_center, all_species, indexing="ij"
+        )
         keys = Labels(
             names=["spherical_harmonics_l", "species_center", "species_neighbor"],
-            values=np.array(
-                [
-                    [l, species_center, species_neighbor]
-                    for l in range(hypers["max_angular"] + 1)
-                    for species_center in global_species
-                    for species_neighbor in global_species
-                ],
-                dtype=np.int32,
+            values=np.stack(
+                [l_grid.ravel(), center_grid.ravel(), neighbor_grid.ravel()], axis=1
             ),
         )
 
         properties = Labels(
             names=["n"],
-            values=np.array([[n] for n in range(hypers["max_radial"])], dtype=np.int32),
+            values=np.arange(hypers["max_radial"], dtype=np.int32).reshape(-1, 1),
         )
 
         lm_slices = []
@@ -395,20 +446,38 @@ class RascalSphericalExpansionTorch:
             data.shape[0], len(global_species), hypers["max_radial"], -1
         )
 
-        blocks = []
-        for l, species_center, species_neighbor in keys:
-            species_neighbor_i = global_species.index(species_neighbor)
-            species_center_mask = np.where(info[:, 2] == species_center)[0]
-            block_data = data[species_center_mask, species_neighbor_i, :, lm_slices[l]]
-            block_data = block_data.swapaxes(1, 2)
-
-            samples = Labels(
+        # slice the blocks on the same device as the data: the row indices
+        # are computed once per center species as torch tensors, so the
+        # gradient-bearing data never moves back to the host
+        species_neighbor_index = {s: i for i, s in enumerate(global_species)}
+        center_species = torch.as_tensor(info[:, 2], device=data.device)
+        rows_by_species_center = {
+            s: (center_species == s).nonzero(as_tuple=True)[0]
+            for s in global_species
+        }
+        samples_by_species_center = {
+            s: Labels(
                 names=["structure", "center"],
-                values=np.copy(info[species_center_mask, :2]).astype(np.int32),
+                values=np.ascontiguousarray(
+                    info[rows.cpu().numpy(), :2].astype(np.int32)
+                ),
             )
+            for s, rows in rows_by_species_center.items()
+        }
+
+        blocks = []
+        for l, species_center, species_neighbor in keys:
+            species_neighbor_i = species_neighbor_index[species_neighbor]
+            rows = rows_by_species_center[species_center]
+            block_data = data.index_select(0, rows)[
+                :, species_neighbor_i, :, lm_slices[l]
+            ]
+            block_data = block_data.transpose(1, 2).contiguous()
+
+            samples = samples_by_species_center[species_center]
             component = Labels(
                 names=["spherical_harmonics_m"],
-                values=np.array([[m] for m in range(-l, l + 1)], dtype=np.int32),
+                values=np.arange(-l, l + 1, dtype=np.int32).reshape(-1, 1),
             )
 
             blocks.append(
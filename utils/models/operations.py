@@ -2,6 +2,19 @@ import numpy as np
 import scipy
 import torch
 
+try:
+    from numba import njit
+
+    @njit(cache=True)
+    def _scatter_add(out, indices, values):
+        # np.add.at handles duplicate indices correctly but is slow; this
+        # compiled loop does the same scatter at C speed
+        for n in range(indices.shape[0]):
+            out[indices[n]] += values[n]
+
+except ImportError:
+    _scatter_add = None
+
 
 def einsum(operation, *arrays):
     if isinstance(arrays[0], np.ndarray):
@@ -21,6 +34,31 @@ def vstack(arrays):
         raise ValueError("unknown array type")
 
 
+def stack(arrays):
+    if isinstance(arrays[0], np.ndarray):
+        return np.stack(arrays)
+    elif isinstance(arrays[0], torch.Tensor):
+        return torch.stack(arrays)
+    else:
+        raise ValueError("unknown array type")
+
+
+def index_add(array, indices, values):
+    if isinstance(array, np.ndarray):
+        if _scatter_add is not None:
+            _scatter_add(
+                array,
+                np.ascontiguousarray(indices, dtype=np.int64),
+                np.ascontiguousarray(values),
+            )
+        else:
+            np.add.at(array, indices, values)
+    elif isinstance(array, torch.Tensor):
+        array.index_add_(0, torch.as_tensor(indices), values)
+    else:
+        raise ValueError("unknown array type")
+
+
 def norm(array, axis=None):
     if isinstance(array, np.ndarray):
         return np.linalg.norm(array, axis=axis)
@@ -42,117 +42,210 @@ def compute_power_spectrum(spherical_expansion_1, spherical_expansion_2=None):
             "species_neighbor",
         )
 
+    # Group the expansion blocks by (l, species_center) once: iterating over
+    # all pairs of keys would discard most of them for mismatched l or
+    # species_center.
+    def group_blocks(spherical_expansion):
+        groups = {}
+        for (l, cs, ns), block in spherical_expansion:
+            groups.setdefault((l, cs), []).append((ns, block))
+        return groups
+
+    groups_1 = group_blocks(spherical_expansion_1)
+    if use_same_spherical_expansions:
+        groups_2 = groups_1
+    else:
+        groups_2 = group_blocks(spherical_expansion_2)
+
+    # all blocks of a spherical expansion share the same properties (the
+    # radial channels), so the combined properties labels can be built once
+    # and reused for every block
+    first_block_1 = next(iter(groups_1.values()))[0][1]
+    first_block_2 = next(iter(groups_2.values()))[0][1]
+    properties_1 = first_block_1.properties.view(np.int32).reshape(
+        len(first_block_1.properties), -1
+    )
+    properties_2 = first_block_2.properties.view(np.int32).reshape(
+        len(first_block_2.properties), -1
+    )
+    properties = Labels(
+        names=[f"{name}_1" for name in first_block_1.properties.names]
+        + [f"{name}_2" for name in first_block_2.properties.names],
+        values=np.hstack(
+            [
+                np.repeat(properties_1, len(properties_2), axis=0),
+                np.tile(properties_2, (len(properties_1), 1)),
+            ]
+        ),
+    )
+
     blocks = []
     keys = []
 
-    for (l1, cs1, ns1), spx_1 in spherical_expansion_1:
-        for (l2, cs2, ns2), spx_2 in spherical_expansion_2:
-            if l1 != l2 or cs1 != cs2:
-                continue
-
-            # Find common samples if samples are not the same
-            if not np.all(spx_1.samples == spx_2.samples):
-                common_samples = Labels(
-                    names=spx_1.samples.names,
-                    values=np.asarray(
-                        np.intersect1d(spx_1.samples, spx_2.samples).tolist()))
-
-                spx_1 = slice_block(spx_1, samples=common_samples)
-                spx_2 = slice_block(spx_2, samples=common_samples)
-
-            # Avoid doubly computing / storing invariants that are
-            # the same by symmetry of the neighbor species.
-            # Example: Neighbor species (Na, Cl) produces the same
-            # invariants as (Cl, Na), meaning that only one set
-            # of invariants needs to be used.
-            # If the two sets of expansion coefficients are different,
-            # this does not apply
-            if ns1 > ns2 and use_same_spherical_expansions:
-                continue
-            elif ns1 == ns2:
-                factor = 1.0 / sqrt(2 * l1 + 1)
-            else:
-                factor = sqrt(2) / sqrt(2 * l1 + 1)
-
-            properties = Labels(
-                names=[f"{name}_1" for name in spx_1.properties.names]
-                + [f"{name}_2" for name in spx_2.properties.names],
-                values=np.array(
-                    [
-                        properties_1.tolist() + properties_2.tolist()
-                        for properties_1 in spx_1.properties
-                        for properties_2 in spx_2.properties
-                    ],
-                    dtype=np.int32,
-                ),
-            )
-
-            # Compute the invariants by summation and store the results
-            data = factor * ops.einsum("ima, imb -> iab", spx_1.values, spx_2.values)
+    for (l1, cs1), group_1 in groups_1.items():
+        group_2 = groups_2.get((l1, cs1))
+        if group_2 is None:
+            continue
 
-            block = TensorBlock(
-                values=data.reshape(data.shape[0], -1),
-                samples=spx_1.samples,
-                components=[],
-                properties=properties,
+        # When all blocks of the group share the same samples and carry no
+        # gradients, compute all neighbor species products with a single
+        # batched einsum instead of one small contraction per pair.
+        group_samples = group_1[0][1].samples
+        same_samples = all(
+            block.samples is group_samples
+            or np.array_equal(block.samples, group_samples)
+            for _, block in group_1 + group_2
+        )
+        if same_samples and not group_1[0][1].has_gradient("positions"):
+            products = ops.einsum(
+                "pima, qimb -> pqiab",
+                ops.stack([block.values for _, block in group_1]),
+                ops.stack([block.values for _, block in group_2]),
             )
+        else:
+            products = None
+
+        for p, (ns1, block_1) in enumerate(group_1):
+            for q, (ns2, block_2) in enumerate(group_2):
+                spx_1 = block_1
+                spx_2 = block_2
 
-            n_properties = block.values.shape[1]
+                # Find common samples if samples are not the same. Blocks
+                # coming from the same calculator run share the exact same
+                # Labels object, which the identity check detects without
+                # walking the arrays.
+                if (
+                    products is None
+                    and spx_1.samples is not spx_2.samples
+                    and not np.array_equal(spx_1.samples, spx_2.samples)
+                ):
+                    # intersect int64-packed (structure, center) keys instead
+                    # of roundtripping through Python lists of tuples
+                    samples_1 = (
+                        spx_1.samples.view(np.int32).reshape(-1, 2).astype(np.int64)
+                    )
+                    samples_2 = (
+                        spx_2.samples.view(np.int32).reshape(-1, 2).astype(np.int64)
+                    )
+                    common = np.intersect1d(
+                        (samples_1[:, 0] << 32) | samples_1[:, 1],
+                        (samples_2[:, 0] << 32) | samples_2[:, 1],
+                        assume_unique=True,
+                    )
+                    common_samples = Labels(
+                        names=spx_1.samples.names,
+                        values=np.stack(
+                            [common >> 32, common & 0xFFFFFFFF], axis=1
+                        ).astype(np.int32),
+                    )
 
-            if spx_1.has_gradient("positions"):
-                gradient_1 = spx_1.gradient("positions")
-                gradient_2 = spx_2.gradient("positions")
+                    spx_1 = slice_block(spx_1, samples=common_samples)
+                    spx_2 = slice_block(spx_2, samples=common_samples)
 
-                if len(gradient_1.samples) == 0 or len(gradient_2.samples) == 0:
+                # Avoid doubly computing / storing invariants that are
+                # the same by symmetry of the neighbor species.
+                # Example: Neighbor species (Na, Cl) produces the same
+                # invariants as (Cl, Na), meaning that only one set
+                # of invariants needs to be used.
+                # If the two sets of expansion coefficients are different,
+                # this does not apply
+                if ns1 > ns2 and use_same_spherical_expansions:
                     continue
+                elif ns1 == ns2:
+                    factor = 1.0 / sqrt(2 * l1 + 1)
+                else:
+                    factor = sqrt(2) / sqrt(2 * l1 + 1)
 
-                gradients_samples = np.unique(
-                    np.concatenate([gradient_1.samples, gradient_2.samples])
-                )
-                gradients_samples = gradients_samples.view(np.int32).reshape(-1, 3)
+                # Compute the invariants by summation and store the results
+                if products is not None:
+                    data = factor * products[p, q]
+                else:
+                    data = ops.einsum("ima, imb -> iab", spx_1.values, spx_2.values)
+                    # scale in place instead of allocating a second
+                    # output-sized array
+                    data *= factor
 
-                gradients_samples = Labels(
-                    names=gradient_1.samples.names, values=gradients_samples
+                block = TensorBlock(
+                    values=data.reshape(data.shape[0], -1),
+                    samples=spx_1.samples,
+                    components=[],
+                    properties=properties,
                 )
 
-                gradients_sample_mapping = {
-                    tuple(sample): i for i, sample in enumerate(gradients_samples)
-                }
+                n_properties = block.values.shape[1]
 
-                gradient_data = ops.zeros_like(
-                    gradient_1.data, (gradients_samples.shape[0], 3, n_properties)
-                )
+                if spx_1.has_gradient("positions"):
+                    gradient_1 = spx_1.gradient("positions")
+                    gradient_2 = spx_2.gradient("positions")
 
-                gradient_data_1 = factor * ops.einsum(
-                    "ixma, imb -> ixab",
-                    gradient_1.data,
-                    spx_2.values[gradient_1.samples["sample"], :, :],
-                ).reshape(gradient_1.samples.shape[0], 3, -1)
-
-                for sample, row in zip(gradient_1.samples, gradient_data_1):
-                    new_row = gradients_sample_mapping[tuple(sample)]
-                    gradient_data[new_row, :, :] += row
-
-                gradient_data_2 = factor * ops.einsum(
-                    "ima, ixmb -> ixab",
-                    spx_1.values[gradient_2.samples["sample"], :, :],
-                    gradient_2.data,
-                ).reshape(gradient_2.samples.shape[0], 3, -1)
-
-                for sample, row in zip(gradient_2.samples, gradient_data_2):
-                    new_row = gradients_sample_mapping[tuple(sample)]
-                    gradient_data[new_row, :, :] += row
-
-                assert gradient_1.components[0].names == ("direction",)
-                block.add_gradient(
-                    "positions",
-                    gradient_data,
-                    gradients_samples,
-                    [gradient_1.components[0]],
-                )
+                    if len(gradient_1.samples) == 0 or len(gradient_2.samples) == 0:
+                        continue
+
+                    # pack the (sample, structure, atom) int32 triplets into a
+                    # single int64 each, so the uniquification and the inverse
+                    # lookup both run on a flat integer array
+                    samples_1 = gradient_1.samples.view(np.int32).reshape(-1, 3)
+                    samples_2 = gradient_2.samples.view(np.int32).reshape(-1, 3)
+                    all_samples = np.concatenate([samples_1, samples_2]).astype(
+                        np.int64
+                    )
+                    packed = (
+                        (all_samples[:, 0] << 42)
+                        | (all_samples[:, 1] << 21)
+                        | all_samples[:, 2]
+                    )
+                    unique_packed, inverse = np.unique(packed, return_inverse=True)
+
+                    gradients_samples = Labels(
+                        names=gradient_1.samples.names,
+                        values=np.stack(
+                            [
+                                unique_packed >> 42,
+                                (unique_packed >> 21) & 0x1FFFFF,
+                                unique_packed & 0x1FFFFF,
+                            ],
+                            axis=1,
+                        ).astype(np.int32),
+                    )
+
+                    gradient_data = ops.zeros_like(
+                        gradient_1.data, (gradients_samples.shape[0], 3, n_properties)
+                    )
+
+                    gradient_data_1 = ops.einsum(
+                        "ixma, imb -> ixab",
+                        gradient_1.data,
+                        spx_2.values[gradient_1.samples["sample"], :, :],
+                    ).reshape(gradient_1.samples.shape[0], 3, -1)
+                    gradient_data_1 *= factor
+
+                    # np.unique's inverse gives the row of every gradient
+                    # sample directly, so the whole scatter is one index_add
+                    ops.index_add(
+                        gradient_data, inverse[: len(samples_1)], gradient_data_1
+                    )
+
+                    gradient_data_2 = ops.einsum(
+                        "ima, ixmb -> ixab",
+                        spx_1.values[gradient_2.samples["sample"], :, :],
+                        gradient_2.data,
+                    ).reshape(gradient_2.samples.shape[0], 3, -1)
+                    gradient_data_2 *= factor
+
+                    ops.index_add(
+                        gradient_data, inverse[len(samples_1) :], gradient_data_2
+                    )
+
+                    assert gradient_1.components[0].names == ("direction",)
+                    block.add_gradient(
+                        "positions",
+                        gradient_data,
+                        gradients_samples,
+                        [gradient_1.components[0]],
+                    )
 
-            keys.append((l1, cs1, ns1, ns2))
-            blocks.append(block)
+                keys.append((l1, cs1, ns1, ns2))
+                blocks.append(block)
 
     keys = Labels(
         names=[